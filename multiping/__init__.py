@@ -18,30 +18,35 @@ limitations under the License.
 __version__ = "1.1.0"
 
 import os
+import sys
 import socket
 import struct
 import time
 import errno
+import select
+import warnings
+import ctypes
+import ctypes.util
+
+from concurrent.futures import ThreadPoolExecutor
 
 # Packet header operations in Python are most easiest done by using the
 # struct package and packing values according to specific formats. For
 # the ICMP header the pack format string is this. Note the '!' in the format
 # string: This means that all packing/unpacking correctly takes network byte
-# order into account.
+# order into account. Formats that are used for every packet are compiled
+# into struct.Struct objects once, further below, so that they don't have to
+# be parsed again on every call.
 _ICMP_HDR_PACK_FORMAT = "!BBHHH"
 
 # Some offsets we use when extracting data from the header
 _ICMP_HDR_OFFSET       = 20
 _ICMP_ID_OFFSET        = _ICMP_HDR_OFFSET + 4
-_ICMP_IDENT_OFFSET     = _ICMP_HDR_OFFSET + 6
-_ICMP_PAYLOAD_OFFSET   = _ICMP_HDR_OFFSET + 8
 _ICMP_ECHO_REQUEST     = 8
 _ICMP_ECHO_REPLY       = 0
 
 _ICMPV6_HDR_OFFSET     = 0
 _ICMPV6_ID_OFFSET      = _ICMPV6_HDR_OFFSET + 4
-_ICMPV6_IDENT_OFFSET   = _ICMPV6_HDR_OFFSET + 6
-_ICMPV6_PAYLOAD_OFFSET = _ICMPV6_HDR_OFFSET + 8
 _ICMPV6_ECHO_REQUEST   = 128
 _ICMPV6_ECHO_REPLY     = 129
 
@@ -49,6 +54,212 @@ _IPPROTO_ICMPV6        = (socket.IPPROTO_ICMPV6
                           if hasattr(socket, 'IPPROTO_ICMPV6')
                           else 58)
 
+# Receive buffer size for our ICMP sockets. Responses tend to arrive in a
+# burst, so the buffer needs to be able to hold one response for every
+# destination. Otherwise, the kernel drops responses, which then show up as
+# false 'no response' results. The kernel accounts for much more than the
+# actual packet size of each buffered packet (typically around 1KB for a small
+# packet), so that's what we reserve per destination.
+_SOCK_RCVBUF_MIN       = 131072
+_SOCK_RCVBUF_PER_ADDR  = 1024
+
+# Maximum number of threads we use to look up target names concurrently
+_MAX_LOOKUP_THREADS    = 64
+
+# Maximum number of packets we hand to the kernel in a single sendmmsg() call.
+# This is a trade-off: The time stamp of each packet is taken when the packet
+# is built, but the packet only leaves once the rest of its batch has been
+# built and the kernel has sent all the packets ahead of it. That delay ends
+# up in the measured ping time. It grows with the batch size (roughly 2us per
+# packet on a fast host), so larger batches save system calls at the cost of
+# accuracy. With 16 packets per batch the error stays in the order of a few
+# tens of microseconds, while we still need only a fraction of the system
+# calls of one sendto() per packet.
+_SEND_BATCH_SIZE       = 16
+
+# Number of packets we can read with a single recvmmsg() call and the size of
+# the buffer for each of them. We are only interested in the headers and our
+# small payload, anything beyond that is cut off.
+_RECV_BATCH_SIZE       = 64
+_RECV_BUF_SIZE         = 128
+
+# We ask the kernel to time stamp every received packet (SO_TIMESTAMPNS). The
+# time stamp is delivered as a control message: A 'struct cmsghdr' (length,
+# level, type), followed by a 'struct timespec' (seconds, nanoseconds). The
+# socket module doesn't export SO_TIMESTAMPNS, so we provide the Linux value.
+_SO_TIMESTAMPNS        = getattr(socket, "SO_TIMESTAMPNS",
+                                 35 if sys.platform.startswith("linux")
+                                 else None)
+_CMSGHDR               = struct.Struct("@Nii")
+_CMSGHDR_SIZE          = _CMSGHDR.size
+_CMSG_ALIGN            = struct.calcsize("N")
+_TIMESPEC              = struct.Struct("@ll")
+_RECV_CTRL_SIZE        = 64
+
+# Our complete echo request packets: The ICMP header followed by the time
+# stamp payload, in nanoseconds. In the echo replies, the ID, ident and time
+# stamp follow each other, so we can read them all at once.
+_ECHO_PKT              = struct.Struct(_ICMP_HDR_PACK_FORMAT + "q")
+_ECHO_PKT_SIZE         = _ECHO_PKT.size
+_ECHO_REPLY            = struct.Struct("!HHq")
+
+# Space we reserve for each destination address in the send buffers. This is
+# the size of a 'struct sockaddr_in6', the larger of the two.
+_SOCKADDR_SIZE         = 28
+
+
+# On Linux we can send a whole batch of packets with a single sendmmsg()
+# system call, rather than calling sendto() for each of them. Likewise,
+# recvmmsg() reads many packets at once. Python's socket module doesn't offer
+# either of them, so we call them in libc via ctypes. These are
+# the C structures it needs, as declared in <sys/socket.h> and <sys/uio.h>.
+# Their layout, as well as that of the socket addresses we build in
+# _sockaddr(), is that of Linux. Other systems, such as FreeBSD, offer the
+# same functions but with different structures, so we only use them on Linux.
+#
+# We deliberately don't use io_uring for this: Its submission helpers in
+# liburing are inline functions, which can't be called via ctypes, and we
+# don't want to depend on a compiled extension. With sendmmsg() and recvmmsg()
+# a whole batch of pings only takes a handful of system calls already. That
+# also means we do without a multishot receive: We still pay for one wait
+# and one recvmmsg() call per burst of responses, which a multishot receive
+# would avoid. We only keep the setup cost down, by registering the sockets
+# for polling and creating the recvmmsg() buffers once, rather than per read.
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base",       ctypes.c_void_p),
+                ("iov_len",        ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name",       ctypes.c_void_p),
+                ("msg_namelen",    ctypes.c_uint32),
+                ("msg_iov",        ctypes.c_void_p),
+                ("msg_iovlen",     ctypes.c_size_t),
+                ("msg_control",    ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags",      ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr",        _MsgHdr),
+                ("msg_len",        ctypes.c_uint)]
+
+
+# Without sendmmsg() we will use sendto(), without recvmmsg() we will use
+# recvmsg().
+_libc_sendmmsg = None
+_libc_recvmmsg = None
+
+if sys.platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _libc_sendmmsg          = _libc.sendmmsg
+        _libc_sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                   ctypes.c_uint, ctypes.c_int]
+        _libc_sendmmsg.restype  = ctypes.c_int
+    except (OSError, AttributeError):
+        # No libc or a libc without sendmmsg()
+        _libc_sendmmsg = None
+
+    try:
+        _libc_recvmmsg          = _libc.recvmmsg
+        _libc_recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                   ctypes.c_uint, ctypes.c_int,
+                                   ctypes.c_void_p]
+        _libc_recvmmsg.restype  = ctypes.c_int
+    except (NameError, AttributeError):
+        # No libc or a libc without recvmmsg()
+        _libc_recvmmsg = None
+
+
+def _sockaddr(family, addr):
+    """
+    Return the packed 'struct sockaddr_in' or 'struct sockaddr_in6' for the
+    given IP address, with the port set to 0.
+
+    The address family is stored in host byte order, the port and address in
+    network byte order. This is the Linux layout, we only need these for
+    sendmmsg(), which we only use on Linux.
+
+    """
+    if family == socket.AF_INET:
+        return struct.pack("=H", family) + \
+               struct.pack("!H4s8x", 0, socket.inet_pton(family, addr))
+    else:
+        return struct.pack("=H", family) + \
+               struct.pack("!HI16sI", 0, 0, socket.inet_pton(family, addr), 0)
+
+
+def _lookup(target, flags=0):
+    """
+    Return the IP address for the specified address or name.
+
+    We prefer IPv4 addresses. Raises socket.gaierror if the target can't be
+    looked up.
+
+    """
+    addr_info = socket.getaddrinfo(target, None, 0, 0, 0, flags)
+
+    # For each specified address or name we may get multiple entries back from
+    # getaddrinfo(). We prefer IPv4 addresses, so we need to search through the
+    # returned results to see if we find one of those.
+    addr = None
+    for res in addr_info:
+        if res[0] == socket.AF_INET:
+            # We found the first IPv4 address! Use this result
+            return res[4][0]
+        elif not addr:
+            # Otherwise, we record the first of the IPv6 addresses
+            addr = res[4][0]
+        # Continue the loop, since we maybe only have had IPv6 addresses so far
+        # and some IPv4 ones are still to come.
+
+    return addr
+
+
+def _lookup_name(name):
+    """
+    Return the IP address for the specified name, or None if the name can't
+    be looked up.
+
+    """
+    try:
+        return _lookup(name)
+    except socket.gaierror:
+        return None
+
+
+def _time_stamp_ns(data):
+    """
+    Convert the 'struct timespec' of a SO_TIMESTAMPNS control message to
+    nanoseconds.
+
+    """
+    sec, nsec = _TIMESPEC.unpack_from(data)
+    return sec * 1000000000 + nsec
+
+
+def _cmsg_time_stamp(ctrl):
+    """
+    Find the SO_TIMESTAMPNS control message in the control data returned by
+    recvmsg()/recvmmsg() and return its time stamp in nanoseconds.
+
+    Returns None if there is no such control message.
+
+    """
+    offset = 0
+    while offset + _CMSGHDR_SIZE <= len(ctrl):
+        cmsg_len, level, cmsg_type = _CMSGHDR.unpack_from(ctrl, offset)
+        if cmsg_len < _CMSGHDR_SIZE:
+            # Malformed, can't continue
+            break
+        if level == socket.SOL_SOCKET and cmsg_type == _SO_TIMESTAMPNS:
+            return _time_stamp_ns(ctrl[offset + _CMSGHDR_SIZE:
+                                       offset + cmsg_len])
+        # Control messages are aligned to the size of a 'size_t'
+        offset += (cmsg_len + _CMSG_ALIGN - 1) & ~(_CMSG_ALIGN - 1)
+    return None
+
 
 class MultiPingError(Exception):
     """
@@ -102,76 +313,181 @@ class MultiPing(object):
         # will prefer the IPv4 addresses.
         self._dest_addrs          = []
         self._unprocessed_targets = []
+        addrs = self._lookup_all(dest_addrs)
         for d in dest_addrs:
-            try:
-                addr_info = socket.getaddrinfo(d, None)
-
-                # For each specified address or name we may get multiple
-                # entries back from getaddrinfo(). We prefer IPv4 addresses, so
-                # we need to search through the returned results to see if we
-                # find one of those.
-                addr = None
-                for res in addr_info:
-                    if res[0] == socket.AF_INET:
-                        # We found the first IPv4 address! Use this result
-                        addr = res[4][0]
-                        break
-                    elif not addr:
-                        # Otherwise, we record the first of the IPv6 addresses
-                        addr = res[4][0]
-                    # Continue the loop, since we maybe only have had IPv6
-                    # addresses so far and some IPv4 ones are still to come.
-
-            except socket.gaierror:
-                if self._ignore_lookup_errors:
-                    # Silently ignore name lookup errors. We can't do anything
-                    # for those hosts. They will be collected in a list of
-                    # unprocessed targets, which will be added to the 'no
-                    # resuts' return list.
-                    addr = None
-                else:
-                    # User wanted to be notified about names/addresses that
-                    # can't be looked up, so we are re-raising the socket
-                    # error that we received. This exception class has
-                    # socket.gaierror as base class, so try-except blocks that
-                    # are looking for socket.gaierror will still work.
-                    raise MultiPingSocketError("Cannot lookup '%s'" % d)
-
+            addr = addrs[d]
             if addr:
                 self._dest_addrs.append(addr)
-            else:
-                # We had a problem collecting information for an address. Can't
-                # process those.
+            elif self._ignore_lookup_errors:
+                # Silently ignore name lookup errors. We can't do anything
+                # for those hosts. They will be collected in a list of
+                # unprocessed targets, which will be added to the 'no
+                # resuts' return list.
                 self._unprocessed_targets.append(d)
+            else:
+                # User wanted to be notified about names/addresses that
+                # can't be looked up, so we are raising a socket error. This
+                # exception class has socket.gaierror as base class, so
+                # try-except blocks that are looking for socket.gaierror will
+                # still work.
+                raise MultiPingSocketError("Cannot lookup '%s'" % d)
+
+        # The packed socket address of each destination, as we hand it to
+        # sendmmsg(). These never change, so we only create them once.
+        self._sockaddrs = {}
+        for a in self._dest_addrs:
+            family = socket.AF_INET6 if ':' in a else socket.AF_INET
+            self._sockaddrs[a] = _sockaddr(family, a)
 
         self._id_to_addr      = {}
-        self._remaining_ids   = None
+        self._remaining_ids   = set()
         self._last_used_id    = None
-        self._time_stamp_size = struct.calcsize("d")
+
+        # IDs of requests from the previous send that never got a response,
+        # mapped to their addresses. A late response to one of those may
+        # still arrive. It carries its own send time stamp, so it is still a
+        # valid result for that address. Until the next send we don't hand
+        # out those IDs again, so such a response can't be mistaken for the
+        # response to a new request. One bit per ID.
+        self._reserved_ids    = bytearray(8192)
+        self._stale_ids       = {}
+
+        # The ID of the latest request to each address
+        self._addr_to_id      = {}
 
         self._receive_has_been_called = False
-        self._ipv6_address_present    = False
 
         # use pid as identifier to filter receive pack from different
         # process echo
         self.ident = os.getpid() & 0xffff
 
-        # Open an ICMP socket, if we weren't provided with one already
+        # We wait for responses with epoll (or poll() where that's not
+        # available) and then read everything that has arrived without
+        # blocking. Since we always read until a socket is empty, epoll can
+        # be edge-triggered: It only reports a socket again once new packets
+        # have arrived.
+        self._use_epoll = hasattr(select, "epoll")
+        if self._use_epoll:
+            self._poller    = select.epoll()
+            self._poll_mask = select.EPOLLIN | select.EPOLLET
+        else:
+            self._poller    = select.poll()
+            self._poll_mask = select.POLLIN
+        self._fd_to_sock = {}
+
+        # Open an ICMP socket, if we weren't provided with one already. An
+        # IPv6 socket is only opened if there are any IPv6 destinations, since
+        # otherwise we would just be woken up by all the other ICMPv6 traffic
+        # on the host.
+        self._sock6 = None
         if sock:
-            self._sock  = sock
-            self._sock6 = None
+            self._sock = sock
         else:
-            self._open_ipv4_icmp_socket()
-            self._open_ipv6_icmp_socket()
+            num_addrs6 = sum(1 for a in self._dest_addrs if ':' in a)
+            self._open_ipv4_icmp_socket(len(self._dest_addrs) - num_addrs6)
+            if num_addrs6:
+                self._open_ipv6_icmp_socket(num_addrs6)
+        self._watch_socket(self._sock)
+
+        # Pre-allocated message headers and buffers for sendmmsg(). Each
+        # message header points to its own slot in the packet buffer and its
+        # own slot in the address buffer. The packets of a batch are built
+        # right in those slots.
+        self._send_buf   = bytearray(_SEND_BATCH_SIZE * _ECHO_PKT_SIZE)
+        self._send_names = bytearray(_SEND_BATCH_SIZE * _SOCKADDR_SIZE)
+        self._send_iovs  = (_IOVec * _SEND_BATCH_SIZE)()
+        self._send_msgs  = (_MMsgHdr * _SEND_BATCH_SIZE)()
+        self._send_pins  = (self._pin_buffer(self._send_buf),
+                            self._pin_buffer(self._send_names))
+        buf_addr, name_addr = [ctypes.addressof(p) for p in self._send_pins]
+        for i in range(_SEND_BATCH_SIZE):
+            self._send_iovs[i].iov_base = buf_addr + i * _ECHO_PKT_SIZE
+            self._send_iovs[i].iov_len  = _ECHO_PKT_SIZE
+            hdr = self._send_msgs[i].msg_hdr
+            hdr.msg_name       = name_addr + i * _SOCKADDR_SIZE
+            hdr.msg_iov        = ctypes.addressof(self._send_iovs[i])
+            hdr.msg_iovlen     = 1
+
+        # Pre-allocated message headers and buffers for recvmmsg(). Each
+        # message header points to its own slot in the receive buffer and its
+        # own slot in the control message buffer, which receives the time
+        # stamp.
+        self._recv_buf  = bytearray(_RECV_BATCH_SIZE * _RECV_BUF_SIZE)
+        self._recv_ctrl = bytearray(_RECV_BATCH_SIZE * _RECV_CTRL_SIZE)
+        self._recv_iovs = (_IOVec * _RECV_BATCH_SIZE)()
+        self._recv_msgs = (_MMsgHdr * _RECV_BATCH_SIZE)()
+        self._recv_pins = (self._pin_buffer(self._recv_buf),
+                           self._pin_buffer(self._recv_ctrl))
+        buf_addr, ctrl_addr = [ctypes.addressof(p) for p in self._recv_pins]
+        for i in range(_RECV_BATCH_SIZE):
+            self._recv_iovs[i].iov_base = buf_addr + i * _RECV_BUF_SIZE
+            self._recv_iovs[i].iov_len  = _RECV_BUF_SIZE
+            hdr = self._recv_msgs[i].msg_hdr
+            hdr.msg_iov        = ctypes.addressof(self._recv_iovs[i])
+            hdr.msg_iovlen     = 1
+            hdr.msg_control    = ctrl_addr + i * _RECV_CTRL_SIZE
+            hdr.msg_controllen = _RECV_CTRL_SIZE
+
+    @staticmethod
+    def _pin_buffer(buf):
+        """
+        Return a ctypes array that shares its memory with a bytearray.
+
+        The message headers hold raw pointers into our buffers. As long as the
+        returned array is kept around, the bytearray can't be resized, which
+        would move its contents somewhere else and leave those pointers
+        dangling. Attempts to do so raise a BufferError instead.
+
+        """
+        return (ctypes.c_char * len(buf)).from_buffer(buf)
 
-    def _open_ipv4_icmp_socket(self):
+    @staticmethod
+    def _lookup_all(targets):
+        """
+        Look up the IP addresses for all specified targets.
+
+        Returns a dict, mapping each target to its IP address, or to None if
+        the target could not be looked up.
+
+        Targets that are IP addresses already are handled right away. The name
+        lookups for all other targets are performed concurrently, so that we
+        don't have to wait for one DNS response after the other.
+
+        """
+        addrs = {}
+        names = []
+        for t in targets:
+            try:
+                addrs[t] = _lookup(t, socket.AI_NUMERICHOST)
+            except socket.gaierror:
+                names.append(t)
+
+        if names:
+            workers = min(_MAX_LOOKUP_THREADS, len(names))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                addrs.update(zip(names, executor.map(_lookup_name, names)))
+
+        return addrs
+
+    def _watch_socket(self, sock):
+        """
+        Switch the socket to non-blocking mode and register it with our
+        epoll/poll object.
+
+        """
+        sock.setblocking(False)
+        self._poller.register(sock.fileno(), self._poll_mask)
+        self._fd_to_sock[sock.fileno()] = sock
+
+    def _open_ipv4_icmp_socket(self, num_addrs):
         self._sock = self._open_icmp_socket(socket.AF_INET)
-        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 131072)
+        self._set_rcvbuf(self._sock, num_addrs)
 
-    def _open_ipv6_icmp_socket(self, ignore_failures=True):
+    def _open_ipv6_icmp_socket(self, num_addrs, ignore_failures=True):
         try:
             self._sock6 = self._open_icmp_socket(socket.AF_INET6)
-            self._sock6.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 131072)
+            self._set_rcvbuf(self._sock6, num_addrs)
+            self._watch_socket(self._sock6)
         except socket.error:
             if ignore_failures:
                 self._sock6 = None
@@ -179,6 +495,32 @@ class MultiPing(object):
             else:
                 raise MultiPingSocketError("IPv6 address family not supported")
 
+    @staticmethod
+    def _set_rcvbuf(sock, num_addrs):
+        """
+        Size the receive buffer of the socket, so that it can hold the
+        responses from the specified number of destinations.
+
+        On Linux, issues a warning if the kernel doesn't allow a buffer of
+        that size.
+
+        """
+        size = max(_SOCK_RCVBUF_MIN, num_addrs * _SOCK_RCVBUF_PER_ADDR)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+
+        # Linux caps the size at net.core.rmem_max. It reports back double
+        # the size it actually set, to account for its bookkeeping overhead.
+        # Other systems don't follow that convention, so we can only tell
+        # whether the size was capped on Linux.
+        if not sys.platform.startswith("linux"):
+            return
+        actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 2
+        if actual < size:
+            warnings.warn("ICMP receive buffer limited to %d bytes, %d bytes "
+                          "wanted for %d destinations. Some responses may be "
+                          "dropped. Raise net.core.rmem_max to avoid this." %
+                          (actual, size, num_addrs))
+
     @staticmethod
     def _open_icmp_socket(family):
         """
@@ -190,7 +532,7 @@ class MultiPing(object):
             proto = socket.IPPROTO_ICMP if family == socket.AF_INET \
                     else _IPPROTO_ICMPV6
 
-            return socket.socket(family, socket.SOCK_RAW, proto)
+            sock = socket.socket(family, socket.SOCK_RAW, proto)
 
         except socket.error as e:
             if e.errno == 1:
@@ -199,86 +541,149 @@ class MultiPing(object):
             # Re-raise any other error
             raise
 
-    def _checksum(self, msg):
+        # Let the kernel time stamp incoming packets, so that the measured
+        # ping time doesn't depend on when we get around to reading them. If
+        # that's not supported, we take the time when we read the packet.
+        if _SO_TIMESTAMPNS is not None:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, _SO_TIMESTAMPNS, 1)
+            except socket.error:
+                pass
+
+        return sock
+
+    def _make_ping(self, slot, icmp_echo_request, hdr_sum, dest_addr):
         """
-        Calculate the checksum of a packet.
+        Build a single ICMPecho (ping) packet in the given slot of the send
+        buffer.
 
-        This is inspired by a response on StackOverflow here:
-        https://stackoverflow.com/a/1769267/7242672
+        The packet consists of:
+        - ICMP type = 8 (v4) / 128 (v6) (unsigned byte)
+        - ICMP code = 0 (unsigned byte)
+        - checksum      (unsigned short)
+        - packet id     (unsigned short)
+        - ident         (unsigned short)
+        - time stamp    (signed long long)
 
-        Thank you to StackOverflow user Jason Orendorff.
+        'hdr_sum' is the sum of those 16 bit words of the header that are the
+        same for all requests of a batch: type/code and ident. The destination
+        address is written to the same slot of the address buffer.
 
         """
-        def carry_around_add(a, b):
-            c = a + b
-            return (c & 0xffff) + (c >> 16)
+        pkt_id = self._last_used_id
 
-        s = 0
-        for i in range(0, len(msg), 2):
-            w = (msg[i] << 8) + msg[i + 1]
-            s = carry_around_add(s, w)
-        s = ~s & 0xffff
+        # The payload consists of the current time stamp. This is returned to
+        # us in the response and allows us to calculate the 'ping time'.
+        time_stamp = time.time_ns()
+
+        # The checksum is the one's complement of the one's complement sum of
+        # all 16 bit words of the packet. Since 2^16 is 1 modulo 0xffff, we
+        # don't need to split the time stamp into its 16 bit words for that:
+        # The time stamp itself is the same as the sum of its words, modulo
+        # 0xffff. So the checksum is just the negated sum of all the fields
+        # modulo 0xffff. This way, the whole packet can be written with a
+        # single pack_into() call, which also takes care of converting
+        # everything to network byte order. Our packets always have this
+        # fixed size, there is no configurable payload, so we don't need a
+        # checksum routine for arbitrary (large) messages.
+        checksum = -(hdr_sum + pkt_id + time_stamp) % 0xffff
+        _ECHO_PKT.pack_into(self._send_buf, slot * _ECHO_PKT_SIZE,
+                            icmp_echo_request, 0, checksum,
+                            pkt_id, self.ident, time_stamp)
+
+        sockaddr = self._sockaddrs[dest_addr]
+        offset   = slot * _SOCKADDR_SIZE
+        self._send_names[offset:offset + len(sockaddr)] = sockaddr
+        self._send_msgs[slot].msg_hdr.msg_namelen = len(sockaddr)
+
+    def _sendmmsg(self, sock, family, num):
+        """
+        Send the first 'num' packets of the send buffer with sendmmsg().
 
-        return s
+        Returns False if sendmmsg() is not available, in which case nothing
+        has been sent. Send errors for individual IPv6 packets are ignored,
+        just like in _send_pkts(). Any other errors are raised.
 
-    def _send_ping(self, dest_addr, payload):
         """
-        Send a single ICMPecho (ping) packet to the specified address.
+        if _libc_sendmmsg is None:
+            return False
+
+        sent = 0
+        while sent < num:
+            res = _libc_sendmmsg(sock.fileno(),
+                                 ctypes.addressof(self._send_msgs[sent]),
+                                 num - sent, 0)
+            if res >= 0:
+                sent += res
+                continue
+            err = ctypes.get_errno()
+            if err == errno.ENOSYS and sent == 0:
+                # Kernel without sendmmsg() support
+                return False
+            elif err == errno.EINTR:
+                continue
+            elif err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # The send buffer is full
+                self._wait_writable(sock)
+            elif family == socket.AF_INET6:
+                # The first packet of the remaining batch could not be sent.
+                # Skip it and carry on with the rest.
+                sent += 1
+            else:
+                raise socket.error(err, os.strerror(err))
 
-        The payload must be specified as a packed byte string. Note that its
-        length has to be divisible by 2 for this to work correctly.
+        return True
 
+    @staticmethod
+    def _wait_writable(sock):
         """
-        pkt_id = self._last_used_id
+        Wait until we can send on the socket again.
 
-        is_ipv6 = ':' in dest_addr
-        if is_ipv6:
-            self._ipv6_address_present = True
-            icmp_echo_request = _ICMPV6_ECHO_REQUEST
-        else:
-            icmp_echo_request = _ICMP_ECHO_REQUEST
-
-        # For checksum calculation we require a dummy header, with the checksum
-        # field set to zero. This header consists of:
-        # - ICMP type = 8 (v4) / 128 (v6) (unsigned byte)
-        # - ICMP code = 0 (unsigned byte)
-        # - checksum  = 0 (unsigned short)
-        # - packet id     (unsigned short)
-        # - sequence  = 0 (unsigned short)  This doesn't have to be 0.
-        dummy_header = bytearray(
-                            struct.pack(_ICMP_HDR_PACK_FORMAT,
-                                        icmp_echo_request, 0, 0,
-                                        pkt_id, self.ident))
-
-        # Calculate the checksum over the combined dummy header and payload
-        checksum = self._checksum(dummy_header + payload)
-
-        # We can now create the real header, which contains the correct
-        # checksum. Need to make sure to convert checksum to network byte
-        # order.
-        real_header = bytearray(
-                            struct.pack(_ICMP_HDR_PACK_FORMAT,
-                                        icmp_echo_request, 0, checksum,
-                                        pkt_id, self.ident))
-
-        # Full packet consists of header plus payload
-        full_pkt = real_header + payload
-
-        # The full address for a sendto operation consists of the IP address
-        # and a port. We don't really need a port for ICMP, so we just use 0
-        # for that.
-        full_dest_addr = (dest_addr, 0)
-
-        if is_ipv6:
-            socket.inet_pton(socket.AF_INET6, dest_addr)
-            try:
-                self._sock6.sendto(full_pkt, full_dest_addr)
-            except Exception:
-                # on systems without IPv6 connectivity, sendto will fail with
-                # 'No route to host'
-                pass
-        else:
-            self._sock.sendto(full_pkt, full_dest_addr)
+        Our sockets are in non-blocking mode, so a send fails with EAGAIN if
+        the socket's send buffer is full.
+
+        """
+        poller = select.poll()
+        poller.register(sock.fileno(), select.POLLOUT)
+        poller.poll()
+
+    def _send_pkts(self, sock, family, dest_addrs):
+        """
+        Send the packets in the send buffer to the given addresses.
+
+        The packet for the n-th address has been built in the n-th slot of
+        the send buffer. Uses a single sendmmsg() call for all of them if
+        possible and falls back to a sendto() call per packet otherwise.
+
+        """
+        if not dest_addrs or not sock or \
+           self._sendmmsg(sock, family, len(dest_addrs)):
+            return
+
+        send_buf = memoryview(self._send_buf)
+        for slot, dest_addr in enumerate(dest_addrs):
+            pkt = send_buf[slot * _ECHO_PKT_SIZE:(slot + 1) * _ECHO_PKT_SIZE]
+            # The full address for a sendto operation consists of the IP
+            # address and a port. We don't really need a port for ICMP, so we
+            # just use 0 for that.
+            full_dest_addr = (dest_addr, 0)
+
+            while True:
+                try:
+                    sock.sendto(pkt, full_dest_addr)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        # The send buffer is full. Try again once there is
+                        # space.
+                        self._wait_writable(sock)
+                        continue
+                    elif e.errno == errno.EINTR:
+                        continue
+                    elif family != socket.AF_INET6:
+                        raise
+                    # on systems without IPv6 connectivity, sendto will fail
+                    # with 'No route to host'
+                break
 
     def send(self):
         """
@@ -295,8 +700,27 @@ class MultiPing(object):
         if not self._receive_has_been_called:
             all_addrs = self._dest_addrs
         else:
-            all_addrs = [a for (i, a) in list(self._id_to_addr.items())
-                         if i in self._remaining_ids]
+            all_addrs = [self._id_to_addr[i] for i in self._remaining_ids]
+
+        # The IDs held back during the last send may be used again. Instead,
+        # we now hold back the IDs that just went stale, so that we can still
+        # accept late responses to them. We can only do so if this leaves
+        # enough free IDs for the new requests, which is the case unless we
+        # are retrying more than half of the possible IDs. Otherwise, late
+        # responses are ignored.
+        for i in self._stale_ids:
+            self._reserved_ids[i >> 3] &= ~(1 << (i & 7))
+        self._stale_ids = {}
+        if len(self._remaining_ids) <= 32768:
+            for i in self._remaining_ids:
+                self._stale_ids[i] = self._id_to_addr[i]
+                self._reserved_ids[i >> 3] |= 1 << (i & 7)
+
+        # From now on we are waiting for responses to the requests of this
+        # batch. Those are the IDs we are going to create now.
+        for i in self._remaining_ids:
+            del self._id_to_addr[i]
+        self._remaining_ids = set()
 
         if self._last_used_id is None:
             # Will attempt to continue at the last request ID we used. But if
@@ -305,82 +729,182 @@ class MultiPing(object):
             # need to trim it down.
             self._last_used_id = int(time.time()) & 0xffff
 
-        # Send ICMPecho to all addresses...
-        for addr in all_addrs:
-            # Make a unique ID, wrapping around at 65535.
-            self._last_used_id = (self._last_used_id + 1) & 0xffff
+        # Each address family has its own socket and packet type, so we
+        # handle them separately.
+        self._send_pings(self._sock, socket.AF_INET,
+                         [a for a in all_addrs if ':' not in a])
+        self._send_pings(self._sock6, socket.AF_INET6,
+                         [a for a in all_addrs if ':' in a])
+
+    def _send_pings(self, sock, family, addrs):
+        """
+        Send ICMPecho requests to all the addresses of one address family.
+
+        The packets are handed to the kernel in batches. Without a socket for
+        the address family, the packets are silently dropped. Those addresses
+        will just not produce any responses.
+
+        """
+        if family == socket.AF_INET:
+            echo_request = _ICMP_ECHO_REQUEST
+        else:
+            echo_request = _ICMPV6_ECHO_REQUEST
+
+        # The packets for this batch only differ in their ID, time stamp and
+        # checksum, so we add up the remaining header fields up front.
+        hdr_sum = (echo_request << 8) + self.ident
+
+        batch = []
+        for addr in addrs:
+            # Make a unique ID, wrapping around at 65535 and skipping the IDs
+            # that are held back.
+            pkt_id = (self._last_used_id + 1) & 0xffff
+            while self._reserved_ids[pkt_id >> 3] & (1 << (pkt_id & 7)):
+                pkt_id = (pkt_id + 1) & 0xffff
+            self._last_used_id = pkt_id
             # Remember the address for each ID so we can produce meaningful
             # result lists later on.
             self._id_to_addr[self._last_used_id] = addr
-            # Send an ICMPecho request packet. We specify a payload consisting
-            # of the current time stamp. This is returned to us in the
-            # response and allows us to calculate the 'ping time'.
-            self._send_ping(addr, payload=struct.pack("d", time.time()))
+            self._addr_to_id[addr] = self._last_used_id
+            self._remaining_ids.add(self._last_used_id)
+            # Create an ICMPecho request packet in the next free slot.
+            self._make_ping(len(batch), echo_request, hdr_sum, addr)
+            batch.append(addr)
+
+            if len(batch) >= _SEND_BATCH_SIZE:
+                self._send_pkts(sock, family, batch)
+                batch = []
 
-    def _read_all_from_socket(self, timeout):
+        self._send_pkts(sock, family, batch)
+
+    def _recv_pkts(self, sock):
         """
-        Read all packets we currently can on the socket.
+        Read all packets that are currently available on the socket, without
+        blocking.
 
-        Returns list of tuples. Each tuple contains a packet and the time at
-        which it was received. NOTE: The receive time is the time when our
-        recv() call returned, which greatly depends on when it was called. The
-        time is NOT the time at which the packet arrived at our host, but it's
-        the closest we can come to the real ping time.
+        Returns a list of tuples, as described for _read_all_from_socket().
+        Uses recvmmsg() to read up to _RECV_BATCH_SIZE packets per system call,
+        if possible. Otherwise, we fall back to a recv() call per packet.
+
+        """
+        if _libc_recvmmsg is None:
+            return self._recv_pkts_one_by_one(sock)
+
+        pkts = []
+        while True:
+            res = _libc_recvmmsg(sock.fileno(),
+                                 ctypes.addressof(self._recv_msgs),
+                                 _RECV_BATCH_SIZE, socket.MSG_DONTWAIT, None)
+            if res < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # No more data available
+                    break
+                elif err == errno.EINTR:
+                    continue
+                elif err == errno.ENOSYS and not pkts:
+                    # Kernel without recvmmsg() support
+                    return self._recv_pkts_one_by_one(sock)
+                raise socket.error(err, os.strerror(err))
+
+            # Packets without a kernel time stamp get the current time
+            now = time.time_ns()
+            for i in range(res):
+                hdr       = self._recv_msgs[i].msg_hdr
+                offset    = i * _RECV_BUF_SIZE
+                pkt       = self._recv_buf[offset:
+                                           offset + self._recv_msgs[i].msg_len]
+                offset    = i * _RECV_CTRL_SIZE
+                ctrl_end  = offset + hdr.msg_controllen
+                recv_time = _cmsg_time_stamp(self._recv_ctrl[offset:ctrl_end])
+                pkts.append((pkt, recv_time or now))
+                # The kernel reduced this to the size it actually used
+                hdr.msg_controllen = _RECV_CTRL_SIZE
+
+            if res < _RECV_BATCH_SIZE:
+                # We got everything there was
+                break
 
-        If nothing was received within the timeout time, the return list is
-        empty.
+        return pkts
 
-        First read is blocking with timeout, so we'll wait at least that long.
-        Then, in case any more packets have arrived, we read everything we can
-        from the socket in non-blocking mode.
+    def _recv_pkts_one_by_one(self, sock):
+        """
+        Read all packets that are currently available on the socket with one
+        non-blocking recv() call per packet.
 
         """
         pkts = []
-        try:
-            self._sock.settimeout(timeout)
-            while True:
-                p = self._sock.recv(64)
-                # Store the packet and the current time
-                pkts.append((bytearray(p), time.time()))
-                # Continue the loop to receive any additional packets that
-                # may have arrived at this point. Changing the socket to
-                # non-blocking (by setting the timeout to 0), so that we'll
-                # only continue the loop until all current packets have been
-                # read.
-                self._sock.settimeout(0)
-        except socket.timeout:
-            # In the first blocking read with timout, we may not receive
-            # anything. This is not an error, it just means no data was
-            # available in the specified time.
-            pass
-        except socket.error as e:
-            # When we read in non-blocking mode, we may get this error with
-            # errno 11 to indicate that no more data is available. That's ok,
-            # just like the timeout.
-            if e.errno == errno.EWOULDBLOCK:
-                pass
-            else:
+        while True:
+            try:
+                p, ancdata, _, _ = sock.recvmsg(_RECV_BUF_SIZE,
+                                                _RECV_CTRL_SIZE,
+                                                socket.MSG_DONTWAIT)
+            except socket.error as e:
+                # We get this error with errno 11 to indicate that no more
+                # data is available.
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
                 # We're not expecting any other socket exceptions, so we
                 # re-raise in that case.
                 raise
+            # Store the packet and the kernel's time stamp or the current time
+            recv_time = None
+            for level, cmsg_type, data in ancdata:
+                if level == socket.SOL_SOCKET and cmsg_type == _SO_TIMESTAMPNS:
+                    recv_time = _time_stamp_ns(data)
+            pkts.append((p, recv_time or time.time_ns()))
+        return pkts
 
-        if self._ipv6_address_present:
-            try:
-                self._sock6.settimeout(timeout)
-                while True:
-                    p = self._sock6.recv(128)
-                    pkts.append((bytearray(p), time.time()))
-                    self._sock6.settimeout(0)
-            except socket.timeout:
-                pass
-            except socket.error as e:
-                if e.errno == errno.EWOULDBLOCK:
-                    pass
-                else:
-                    raise
+    def _read_all_from_socket(self, timeout_ns):
+        """
+        Read all packets we currently can on the sockets.
+
+        Returns list of tuples. Each tuple contains a packet and the time at
+        which it was received, in nanoseconds. The receive time is the time
+        stamp the kernel recorded when the packet arrived at our host. Only if
+        the kernel doesn't provide that, it is the time when our recv() call
+        returned, which greatly depends on when it was called.
+
+        If nothing was received within the timeout time (in nanoseconds), the
+        return list is empty.
+
+        We wait with epoll/poll until any of our sockets is readable or the
+        timeout has passed, so we'll wait at most that long. Then we read
+        everything we can from the readable sockets in non-blocking mode.
+
+        """
+        pkts = []
+        if self._use_epoll:
+            # epoll wants the timeout in seconds
+            events = self._poller.poll(timeout_ns / 1e9)
+        else:
+            # poll() wants the timeout in milliseconds. We round up, so that
+            # we don't return early and spin on the last fraction of a
+            # millisecond.
+            events = self._poller.poll(-(-timeout_ns // 1000000))
+        for fd, _ in events:
+            pkts.extend(self._recv_pkts(self._fd_to_sock[fd]))
 
         return pkts
 
+    def _pending_id(self, pkt_id):
+        """
+        Return the ID of the request that is answered by a response with the
+        given ID, or None if we are not waiting for that response.
+
+        Usually, that's the same ID. A late response to a request of the
+        previous send answers the current request to the same address, as
+        long as we haven't received a response for that one, yet.
+
+        """
+        if pkt_id in self._remaining_ids:
+            return pkt_id
+        addr   = self._stale_ids.get(pkt_id)
+        pkt_id = self._addr_to_id.get(addr)
+        if pkt_id in self._remaining_ids:
+            return pkt_id
+        return None
+
     def receive(self, timeout):
         """
         Receive ping responses from the socket. Attempts to read responses for
@@ -394,27 +918,23 @@ class MultiPing(object):
           yet
 
         """
-        if not self._id_to_addr:
+        if self._last_used_id is None:
             raise MultiPingError("No requests have been sent, yet.")
 
         self._receive_has_been_called = True
 
-        # Continue with any remaining IDs for which we hadn't received an
-        # answer, yet...
-        if self._remaining_ids is None:
-            # ... but if we don't have any stored yet, then we are just calling
-            # receive() for the first time afer a send. We initialize
-            # the list of expected IDs from all the IDs we created during the
-            # send().
-            self._remaining_ids = list(self._id_to_addr.keys())
-
-        remaining_time = timeout
-        results        = {}
+        # The deadline is in nanoseconds of the monotonic clock, so that it
+        # isn't affected by changes to the system time.
+        deadline = time.perf_counter_ns() + int(timeout * 1e9)
+        results  = {}
 
         # Keep looping until we either have responses for all request IDs, or
         # no more time is left.
-        while self._remaining_ids and remaining_time > 0:
-            start_time = time.time()
+        while self._remaining_ids:
+            # Calculate how much of the available overall timeout time is left
+            remaining_time = deadline - time.perf_counter_ns()
+            if remaining_time <= 0:
+                break
             pkts = self._read_all_from_socket(remaining_time)
 
             for pkt, resp_receive_time in pkts:
@@ -425,41 +945,33 @@ class MultiPing(object):
                     pkt_ident = None
                     if pkt[_ICMPV6_HDR_OFFSET] == _ICMPV6_ECHO_REPLY:
 
-                        pkt_id = (pkt[_ICMPV6_ID_OFFSET] << 8) + \
-                            pkt[_ICMPV6_ID_OFFSET + 1]
-                        pkt_ident = (pkt[_ICMPV6_IDENT_OFFSET] << 8) + \
-                            pkt[_ICMPV6_IDENT_OFFSET + 1]
-                        payload = pkt[_ICMPV6_PAYLOAD_OFFSET:]
+                        # ID, ident and the time stamp in the payload follow
+                        # each other. The sending time stamp was encoded in
+                        # the echo request body and is now returned to us in
+                        # the response.
+                        pkt_id, pkt_ident, req_sent_time = \
+                            _ECHO_REPLY.unpack_from(pkt, _ICMPV6_ID_OFFSET)
 
                     elif pkt[_ICMP_HDR_OFFSET] == _ICMP_ECHO_REPLY:
 
-                        pkt_id = (pkt[_ICMP_ID_OFFSET] << 8) + \
-                            pkt[_ICMP_ID_OFFSET + 1]
-                        pkt_ident = (pkt[_ICMP_IDENT_OFFSET] << 8) + \
-                            pkt[_ICMP_IDENT_OFFSET + 1]
-                        payload = pkt[_ICMP_PAYLOAD_OFFSET:]
-
-                    if pkt_ident == self.ident and \
-                       pkt_id in self._remaining_ids:
-                        # The sending timestamp was encoded in the echo request
-                        # body and is now returned to us in the response. Note
-                        # that network byte order doesn't matter here, since we
-                        # get exactly the order of bytes back that we
-                        # originally sent from this host.
-                        req_sent_time = struct.unpack(
-                            "d", payload[:self._time_stamp_size])[0]
-                        results[self._id_to_addr[pkt_id]] = \
-                            resp_receive_time - req_sent_time
-
-                        self._remaining_ids.remove(pkt_id)
-                except IndexError:
+                        pkt_id, pkt_ident, req_sent_time = \
+                            _ECHO_REPLY.unpack_from(pkt, _ICMP_ID_OFFSET)
+
+                    if pkt_ident != self.ident:
+                        # Not one of ours
+                        continue
+                    pkt_id = self._pending_id(pkt_id)
+                    if pkt_id is not None:
+                        # We don't need to remember the address for this ID
+                        # anymore, it's in the results now.
+                        results[self._id_to_addr.pop(pkt_id)] = \
+                            (resp_receive_time - req_sent_time) / 1e9
+
+                        self._remaining_ids.discard(pkt_id)
+                except (IndexError, struct.error):
                     # Silently ignore malformed packets
                     pass
 
-            # Calculate how much of the available overall timeout time is left
-            end_time = time.time()
-            remaining_time = remaining_time - (end_time - start_time)
-
         no_results_so_far = [self._id_to_addr[i] for i in self._remaining_ids]
         if self._ignore_lookup_errors:
             # With this flag set, names/addresses that we couldn't look up will
@@ -475,6 +987,8 @@ class MultiPing(object):
         self._sock.close()
         if self._sock6:
             self._sock6.close()
+        if self._use_epoll:
+            self._poller.close()
 
 
 def multi_ping(dest_addrs, timeout, retry=0, ignore_lookup_errors=False):
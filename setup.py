@@ -45,9 +45,11 @@ setup(
                            "request (ping) to monitor IP addresses",
     long_description     = long_description,
     packages             = find_packages(),
+    python_requires      = ">=3.7",
     include_package_data = True,
     classifiers          = [
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3 :: Only',
         'Natural Language :: English',
         'Environment :: Plugins',
         'Intended Audience :: Developers',